@@ -24,6 +24,6 @@ __version__ = '1.1.0'
 import flask
 import os
 
-app = flask.Flask(__name__)
-app.template_folder = os.path.join(os.path.dirname(__file__), 'templates')
-app.static_folder = os.path.join(os.path.dirname(__file__), 'static')
+app = flask.Flask(__name__,
+  template_folder=os.path.join(os.path.dirname(__file__), 'templates'),
+  static_folder=os.path.join(os.path.dirname(__file__), 'static'))
@@ -20,7 +20,9 @@
 '''
 This module implements the Flux worker queue. Flux will start one or
 more threads (based on the ``parallel_builds`` configuration value)
-that will process the queue.
+that will process the queue. The threads spend most of their time
+waiting for Git and the build script subprocesses, so builds run in
+parallel regardless of the GIL.
 '''
 
 from flux import app, config, utils, models
@@ -49,6 +51,7 @@ class BuildConsumer(object):
     self._cond = Condition()
     self._running = False
     self._queue = deque()
+    self._queued = set()  # IDs in _queue that have not been removed
     self._terminate_events = {}
     self._threads = []
 
@@ -61,10 +64,23 @@ class BuildConsumer(object):
     if build.status != Build.Status_Queued:
       raise TypeError('build status must be {!r}'.format(Build.Status_Queued))
     with self._cond:
-      if build.id not in self._queue:
+      if build.id not in self._queued:
+        self._queued.add(build.id)
         self._queue.append(build.id)
         self._cond.notify()
 
+  def remove(self, build):
+    ''' Removes a :class:`Build` from the queue. Returns #True if the build
+    was removed, #False if it was not queued (eg. because a worker already
+    picked it up). The build status is not changed. '''
+
+    with self._cond:
+      if build.id in self._queued:
+        # The ID stays in the deque and is skipped by the worker.
+        self._queued.remove(build.id)
+        return True
+      return False
+
   def terminate(self, build):
     ''' Given a :class:`Build` object, terminates the ongoing build
     process or removes the build from the queue and sets its status
@@ -75,8 +91,9 @@ class BuildConsumer(object):
     with self._cond:
       if build.id in self._terminate_events:
         self._terminate_events[build.id].set()
-      elif build.id in self._queue:
-        self._queue.remove(build.id)
+      elif build.id in self._queued:
+        # The ID stays in the deque and is skipped by the worker.
+        self._queued.remove(build.id)
       build.status = build.Status_Stopped
 
   def stop(self, join=True):
@@ -84,7 +101,7 @@ class BuildConsumer(object):
       for event in self._terminate_events.values():
         event.set()
       self._running = False
-      self._cond.notify()
+      self._cond.notify_all()
     if join:
       [t.join() for t in self._threads]
 
@@ -97,6 +114,9 @@ class BuildConsumer(object):
           if not self._running:
             break
           build_id = self._queue.popleft()
+          if build_id not in self._queued:
+            continue
+          self._queued.remove(build_id)
         with models.session():
           build = Build.get(id=build_id)
           if not build or build.status != Build.Status_Queued:
@@ -111,6 +131,8 @@ class BuildConsumer(object):
           with self._cond:
             self._terminate_events.pop(build_id)
 
+    if num_threads is None:
+      num_threads = os.cpu_count() or 1
     if num_threads < 1:
       raise ValueError('num_threads must be >= 1')
     with self._cond:
@@ -122,11 +144,12 @@ class BuildConsumer(object):
 
   def is_running(self, build):
     with self._cond:
-      return build.id in self._queue
+      return build.id in self._queued
 
 
 _consumer = BuildConsumer()
 enqueue = _consumer.put
+dequeue = _consumer.remove
 terminate_build = _consumer.terminate
 run_consumers = _consumer.start
 stop_consumers = _consumer.stop
@@ -245,8 +268,8 @@ def do_build_(build, build_path, override_path, logger, logfile, terminate_event
     is_ref_build = False
 
   # Checkout the correct build_start_point.
-  checkout_cmd = ['git', 'checkout', '-q', build_start_point]
-  res = utils.run(checkout_cmd, logger, cwd=build_path)
+  checkout_cmd = ['git', '-C', build_path, 'checkout', '-q', build_start_point]
+  res = utils.run(checkout_cmd, logger)
   if res != 0:
     logger.error('[Flux]: failed to checkout {!r}'.format(build_start_point))
     return False
@@ -254,8 +277,8 @@ def do_build_(build, build_path, override_path, logger, logfile, terminate_event
   # If checkout was initiated by Start build, update commit_sha and ref of build
   if is_ref_build:
     # update commit sha
-    get_ref_sha_cmd = ['git', 'rev-parse', 'HEAD']
-    res_ref_sha, res_ref_sha_stdout = utils.run(get_ref_sha_cmd, logger, cwd=build_path, return_stdout=True)
+    get_ref_sha_cmd = ['git', '-C', build_path, 'rev-parse', 'HEAD']
+    res_ref_sha, res_ref_sha_stdout = utils.run(get_ref_sha_cmd, logger, return_stdout=True)
     if res_ref_sha == 0 and res_ref_sha_stdout != None:
       with models.session():
         Build.get(id=build.id).commit_sha = res_ref_sha_stdout.strip()
@@ -263,8 +286,8 @@ def do_build_(build, build_path, override_path, logger, logfile, terminate_event
       logger.error('[Flux]: failed to read current sha')
       return False
     # update ref; user could enter just branch name, e.g 'master'
-    get_ref_cmd = ['git', 'rev-parse', '--symbolic-full-name', build_start_point]
-    res_ref, res_ref_stdout = utils.run(get_ref_cmd, logger, cwd=build_path, return_stdout=True)
+    get_ref_cmd = ['git', '-C', build_path, 'rev-parse', '--symbolic-full-name', build_start_point]
+    res_ref, res_ref_stdout = utils.run(get_ref_cmd, logger, return_stdout=True)
     if res_ref == 0 and res_ref_stdout != None and res_ref_stdout.strip() != 'HEAD' and res_ref_stdout.strip() != '':
       with models.session():
         Build.get(id=build.id).ref = res_ref_stdout.strip()
@@ -83,6 +83,7 @@ def start_web():
   app.secret_key = config.secret_key
   app.config['DEBUG'] = config.debug
   app.config['SERVER_NAME'] = config.server_name
+  app.config['USE_X_SENDFILE'] = getattr(config, 'use_x_sendfile', False)
   print('DEBUG = {}'.format(config.debug))
   print('SERVER_NAME = {}'.format(config.server_name))
 
@@ -44,11 +44,26 @@ class User(db.Entity):
   def set_password(self, password):
     self.passhash = utils.hash_pw(password)
 
+  def check_password(self, password):
+    """
+    Returns #True if *password* matches the user's password hash. If the
+    hash was generated with #utils.hash_pw_legacy(), it is replaced with
+    the current hash.
+    """
+
+    if utils.compare_secret(self.passhash, utils.hash_pw(password)):
+      return True
+    if utils.compare_secret(self.passhash, utils.hash_pw_legacy(password)):
+      self.set_password(password)
+      return True
+    return False
+
   @classmethod
   def get_by_login_details(cls, user_name, password):
-    passhash = utils.hash_pw(password)
-    return orm.select(x for x in cls if x.name == user_name and
-                        x.passhash == passhash).first()
+    user = cls.get(name=user_name)
+    if user and user.check_password(password):
+      return user
+    return None
 
   @classmethod
   def get_root_user(cls):
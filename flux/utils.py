@@ -25,80 +25,116 @@ import hmac
 import logging
 import os
 import re
+import secrets
 import shlex
 import shutil
 import stat
 import subprocess
 import urllib.parse
-import uuid
 import werkzeug
 import zipfile
 
 from . import app, config, models
 from urllib.parse import urlparse
 from flask import request, session, redirect, url_for, Response
+from werkzeug.wsgi import wrap_file
 from datetime import datetime
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 
 
-def get_raise(data, key, expect_type=None):
-  ''' Helper function to retrieve an element from a JSON data structure.
-  The *key* must be a string and may contain periods to indicate nesting.
-  Parts of the key may be a string or integer used for indexing on lists.
-  If *expect_type* is not None and the retrieved value is not of the
-  specified type, TypeError is raised. If the key can not be found,
-  KeyError is raised. '''
+@functools.lru_cache(maxsize=512)
+def _compile_key(key):
+  ''' Splits a :func:`get_raise` *key* into a tuple of its parts. Parts
+  that represent an integer are converted to :class:`int`. '''
 
-  parts = key.split('.')
-  resolved = ''
-  for part in parts:
-    resolved += part
+  parts = []
+  for part in key.split('.'):
     try:
       part = int(part)
     except ValueError:
       pass
+    parts.append(part)
+  return tuple(parts)
+
 
+def _resolved_key(key, index):
+  ''' Returns the part of *key* that was resolved up to the part at
+  *index*, used for error messages. '''
+
+  return '.'.join(key.split('.')[:index + 1])
+
+
+_RAISE = object()
+
+
+def _lookup(data, key, expect_type, default):
+  ''' Implements :func:`get_raise` and :func:`get`. If *default* is
+  #_RAISE, errors are raised, otherwise *default* is returned instead.
+  Missing keys are detected without raising and catching exceptions. '''
+
+  for index, part in enumerate(_compile_key(key)):
     if isinstance(part, str):
       if not isinstance(data, dict):
-        raise TypeError('expected dictionary to access {!r}'.format(resolved))
-      try:
-        data = data[part]
-      except KeyError:
-        raise KeyError(resolved)
-    elif isinstance(part, int):
-      if not isinstance(data, list):
-        raise TypeError('expected list to access {!r}'.format(resolved))
-      try:
-        data = data[part]
-      except IndexError:
-        raise KeyError(resolved)
+        if default is not _RAISE:
+          return default
+        raise TypeError('expected dictionary to access {!r}'.format(
+          _resolved_key(key, index)))
+      data = data.get(part, _RAISE)
+      if data is _RAISE:
+        if default is not _RAISE:
+          return default
+        raise KeyError(_resolved_key(key, index))
     else:
-      assert False, "unreachable"
-
-    resolved += '.'
+      if not isinstance(data, list):
+        if default is not _RAISE:
+          return default
+        raise TypeError('expected list to access {!r}'.format(
+          _resolved_key(key, index)))
+      if not -len(data) <= part < len(data):
+        if default is not _RAISE:
+          return default
+        raise KeyError(_resolved_key(key, index))
+      data = data[part]
 
   if expect_type is not None and not isinstance(data, expect_type):
+    if default is not _RAISE:
+      return default
     raise TypeError('expected {!r} but got {!r} instead for {!r}'.format(
       expect_type.__name__, type(data).__name__, key))
   return data
 
 
+def get_raise(data, key, expect_type=None):
+  ''' Helper function to retrieve an element from a JSON data structure.
+  The *key* must be a string and may contain periods to indicate nesting.
+  Parts of the key may be a string or integer used for indexing on lists.
+  If *expect_type* is not None and the retrieved value is not of the
+  specified type, TypeError is raised. If the key can not be found,
+  KeyError is raised. '''
+
+  return _lookup(data, key, expect_type, _RAISE)
+
+
 def get(data, key, expect_type=None, default=None):
   ''' Same as :func:`get_raise`, but returns *default* if the key could
   not be found or the datatype doesn't match. '''
 
-  try:
-    return get_raise(data, key, expect_type)
-  except (TypeError, ValueError):
-    return default
+  return _lookup(data, key, expect_type, default)
+
+
+@functools.lru_cache(maxsize=16)
+def _basic_auth_headers(message):
+  return (('WWW-Authenticate', 'Basic realm="{}"'.format(message)),)
 
 
 def basic_auth(message='Login required'):
-  ''' Sends a 401 response that enables basic auth. '''
+  ''' Sends a 401 response that enables basic auth. Note that a new
+  response object is created every time, as Flask modifies it after the
+  view returned (eg. to save the session cookie). '''
 
-  headers = {'WWW-Authenticate': 'Basic realm="{}"'.format(message)}
+  headers = _basic_auth_headers(message)
   return Response('Please log in.', 401, headers, mimetype='text/plain')
 
 
@@ -109,7 +145,7 @@ def requires_auth(func):
   def wrapper(*args, **kwargs):
     ip = request.remote_addr
     token_string = session.get('flux_login_token')
-    token = models.LoginToken.select(lambda t: t.token == token_string).first()
+    token = models.LoginToken.get(token=token_string) if token_string else None
     if not token or token.ip != ip or token.expired():
       if token and token.expired():
         flash("Your login session has expired.")
@@ -176,6 +212,9 @@ def with_logger(kwarg='logger', stream_dest_kwarg='stream', replace=True):
   return decorator
 
 
+_DEFAULT_FORMATTER = logging.Formatter('[%(asctime)-15s - %(levelname)s]: %(message)s')
+
+
 def create_logger(stream, name=__name__, fmt=None):
   ''' Creates a new :class:`logging.Logger` object with the
   specified *name* and *fmt* (defaults to a standard logging
@@ -183,8 +222,7 @@ def create_logger(stream, name=__name__, fmt=None):
 
   The logger will also output to stderr. '''
 
-  fmt = fmt or '[%(asctime)-15s - %(levelname)s]: %(message)s'
-  formatter = logging.Formatter(fmt)
+  formatter = logging.Formatter(fmt) if fmt else _DEFAULT_FORMATTER
 
   logger = logging.Logger(name)
   handler = logging.StreamHandler(stream)
@@ -195,16 +233,29 @@ def create_logger(stream, name=__name__, fmt=None):
 
 
 def stream_file(filename, name=None, mime=None):
-  def generate():
-    with open(filename, 'rb') as fp:
-      yield from fp
+  ''' Sends the file at *filename* as an attachment. The file object is
+  handed to the WSGI server's ``wsgi.file_wrapper`` (if available), which
+  allows the server to use sendfile(2). If ``USE_X_SENDFILE`` is enabled,
+  only an ``X-Sendfile`` header is sent and the front-end server transfers
+  the file instead. '''
+
   if name is None:
     name = os.path.basename(filename)
   headers = {}
   headers['Content-Type'] = mime or 'application/x-octet-stream'
-  headers['Content-Length'] = os.stat(filename).st_size
   headers['Content-Disposition'] = 'attachment; filename="' + name + '"'
-  return Response(generate(), 200, headers)
+  if app.config.get('USE_X_SENDFILE'):
+    headers['Content-Length'] = os.stat(filename).st_size
+    headers['X-Sendfile'] = os.path.abspath(filename)
+    return Response(None, 200, headers)
+  fp = open(filename, 'rb')
+  try:
+    headers['Content-Length'] = os.fstat(fp.fileno()).st_size
+    return Response(wrap_file(request.environ, fp), 200, headers,
+      direct_passthrough=True)
+  except BaseException:
+    fp.close()
+    raise
 
 
 def flash(message=None):
@@ -215,10 +266,17 @@ def flash(message=None):
 
 
 def make_secret():
-  return str(uuid.uuid4())
+  return secrets.token_urlsafe(16)
 
 
 def hash_pw(pw):
+  return hashlib.blake2b(pw.encode('utf8'), digest_size=16).hexdigest()
+
+
+def hash_pw_legacy(pw):
+  ''' The MD5 password hash used by previous versions of Flux CI. Only
+  used to validate and upgrade password hashes stored by these versions. '''
+
   return hashlib.md5(pw.encode('utf8')).hexdigest()
 
 
@@ -246,14 +304,31 @@ def rmtree(path, remove_write_protection=False):
   shutil.rmtree(path, onerror=on_rm_error)
 
 
+def _iter_files(dirname, prefix=''):
+  ''' Recursively yields ``(path, arcname)`` tuples for all files in
+  *dirname*. Like :func:`os.walk`, symlinks to directories are not
+  followed and not yielded, and directories that can not be read are
+  skipped. '''
+
+  try:
+    entries = os.scandir(dirname)
+  except OSError:
+    return
+  with entries:
+    for entry in entries:
+      arcname = prefix + entry.name
+      if entry.is_dir():
+        if not entry.is_symlink():
+          yield from _iter_files(entry.path, arcname + '/')
+      else:
+        yield entry.path, arcname
+
+
 def zipdir(dirname, filename):
   dirname = os.path.abspath(dirname)
-  zipf = zipfile.ZipFile(filename, 'w')
-  for root, dirs, files in os.walk(dirname):
-    for fname in files:
-      arcname = os.path.join(os.path.relpath(root, dirname), fname)
-      zipf.write(os.path.join(root, fname), arcname)
-  zipf.close()
+  with zipfile.ZipFile(filename, 'w') as zipf:
+    for path, arcname in _iter_files(dirname):
+      zipf.write(path, arcname)
 
 
 def secure_filename(filename):
@@ -306,6 +381,8 @@ def run(command, logger, cwd=None, env=None, shell=False, return_stdout=False,
   cwd (str, None): The current working directory.
   env (dict, None): The environment for the subprocess.
   shell (bool): If set to #True, execute the command via the system shell.
+      Prefer passing a list of arguments instead, as this avoids spawning
+      an additional shell process.
   return_stdout (bool): Return the output of the command (including stderr)
       to the caller. The result will be a tuple of (returncode, output).
   inherit_env (bool): Inherit the current process' environment.
@@ -323,7 +400,7 @@ def run(command, logger, cwd=None, env=None, shell=False, return_stdout=False,
   else:
     if isinstance(command, str):
       command = shlex.split(command)
-    if logger:
+    if logger and logger.isEnabledFor(logging.INFO):
       logger.info('$ ' + ' '.join(map(quote, command)))
 
   if env is None:
@@ -331,9 +408,19 @@ def run(command, logger, cwd=None, env=None, shell=False, return_stdout=False,
   if inherit_env:
     env = {**os.environ, **env}
 
+  # On POSIX, CPython can launch the process with posix_spawn() instead of
+  # fork() + exec() if the executable is an absolute path, no *cwd* is set
+  # and file descriptors are not closed explicitly. Descriptors opened by
+  # Python are non-inheritable anyway (PEP 446).
+  executable = None
+  if os.name == 'posix' and not shell and cwd is None and 'PATH' in env:
+    executable = shutil.which(command[0], path=env['PATH'])
+  close_fds = executable is None
+
   popen = subprocess.Popen(
-    command, cwd=cwd, env=env, shell=shell, stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT, stdin=None)
+    command, executable=executable, cwd=cwd, env=env, shell=shell,
+    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=None,
+    close_fds=close_fds)
   stdout = popen.communicate()[0].decode()
   if stdout:
     if popen.returncode != 0 and logger:
@@ -346,20 +433,24 @@ def run(command, logger, cwd=None, env=None, shell=False, return_stdout=False,
   return popen.returncode
 
 
+_DEFAULT_SSH_OPTIONS = ('-oBatchMode=yes',)
+
+
 def ssh_command(url, *args, no_ptty=False, identity_file=None,
     verbose=None, options=None):
   ''' Helper function to generate an SSH command. If not options are
   specified, the default option ``BatchMode=yes`` will be set. '''
 
-  if options is None:
-    options = {'BatchMode': 'yes'}
   if verbose is None:
     verbose = config.ssh_verbose
 
   command = ['ssh']
   if url is not None:
     command.append(url)
-  command += ['-o{}={}'.format(k, v) for (k, v) in options.items()]
+  if options is None:
+    command.extend(_DEFAULT_SSH_OPTIONS)
+  else:
+    command.extend('-o{}={}'.format(k, v) for (k, v) in options.items())
   if no_ptty:
     command.append('-T')
   if identity_file:
@@ -399,6 +490,42 @@ def get_bitbucket_signature(secret, payload_data):
   return hmac.new(secret.encode('utf8'), payload_data, hashlib.sha256).hexdigest()
 
 
+@functools.lru_cache(maxsize=128)
+def _keyed_hmac(secret, digestmod):
+  ''' Returns an HMAC object keyed with *secret* that has not been fed any
+  data yet. Callers must update a copy of it, which saves deriving the
+  inner and outer keys for every webhook. '''
+
+  return hmac.new(secret.encode('utf8'), None, digestmod)
+
+
+def check_signature(secret, payload_data, signature, digestmod=hashlib.sha1):
+  ''' Checks the hex-encoded HMAC *signature* received with a webhook
+  against the HMAC of *payload_data* keyed with the repository *secret*.
+  The raw digests are compared in constant time. Returns #False if the
+  *signature* is not valid hex. '''
+
+  try:
+    received = bytes.fromhex(signature)
+  except ValueError:
+    return False
+  mac = _keyed_hmac(secret, digestmod).copy()
+  mac.update(payload_data)
+  return hmac.compare_digest(mac.digest(), received)
+
+
+def compare_secret(expected, received):
+  ''' Compares the *received* value (eg. a webhook secret or a password
+  hash) with the *expected* value in constant time. Both values may be
+  strings or bytes, strings are UTF-8 encoded before the comparison. '''
+
+  if isinstance(expected, str):
+    expected = expected.encode('utf8')
+  if isinstance(received, str):
+    received = received.encode('utf8')
+  return hmac.compare_digest(expected, received)
+
+
 def get_date_diff(date1, date2):
   if (not date1) or (not date2):
     if (not date1) and date2:
@@ -19,16 +19,22 @@
 # THE SOFTWARE.
 
 from flux import app, config, file_utils, models, utils
-from flux.build import enqueue, terminate_build
+from flux.build import enqueue, dequeue, terminate_build
 from flux.models import User, LoginToken, Repository, Build, get_target_for, select, desc
 from flux.utils import secure_filename
 from flask import request, session, redirect, url_for, render_template, abort
 from datetime import datetime
 
+import hashlib
 import json
 import os
 import uuid
 
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 API_GOGS = 'gogs'
 API_GITHUB = 'github'
 API_GITEA = 'gitea'
@@ -67,7 +73,10 @@ def hook_push(logger):
   logger.info('PUSH event received. Processing JSON payload.')
   try:
     # XXX Determine encoding from Request Headers, if possible.
-    data = json.loads(request.data.decode('utf8'))
+    if orjson is not None:
+      data = orjson.loads(request.data)
+    else:
+      data = json.loads(request.data.decode('utf8'))
   except (UnicodeDecodeError, ValueError) as exc:
     logger.error('Invalid JSON data received: {}'.format(exc))
     return 400
@@ -78,7 +87,7 @@ def hook_push(logger):
     ref = utils.get(data, 'ref', str)
     commit = utils.get(data, 'after', str)
     secret = utils.get(data, 'secret', str)
-    get_repo_secret = lambda r: r.secret
+    verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_GITHUB:
     event = request.headers.get('X-Github-Event')
     if event != 'push':
@@ -89,7 +98,7 @@ def hook_push(logger):
     ref = utils.get(data, 'ref', str)
     commit = utils.get(data, 'after', str)
     secret = request.headers.get('X-Hub-Signature', '').replace('sha1=', '')
-    get_repo_secret = lambda r: utils.get_github_signature(r.secret, request.data)
+    verify_secret = lambda r: utils.check_signature(r.secret, request.data, secret)
   elif api == API_GITEA:
     event = request.headers.get('X-Gitea-Event')
     if event != 'push':
@@ -100,7 +109,7 @@ def hook_push(logger):
     ref = utils.get(data, 'ref', str)
     commit = utils.get(data, 'after', str)
     secret = utils.get(data, 'secret', str)
-    get_repo_secret = lambda r: r.secret
+    verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_GITBUCKET:
     event = request.headers.get('X-Github-Event')
     if event != 'push':
@@ -112,9 +121,9 @@ def hook_push(logger):
     commit = utils.get(data, 'after', str)
     secret = request.headers.get('X-Hub-Signature', '').replace('sha1=', '')
     if secret:
-      get_repo_secret = lambda r: utils.get_github_signature(r.secret, request.data)
+      verify_secret = lambda r: utils.check_signature(r.secret, request.data, secret)
     else:
-      get_repo_secret = lambda r: r.secret
+      verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_BITBUCKET:
     event = request.headers.get('X-Event-Key')
     if event != 'repo:refs_changed':
@@ -126,9 +135,10 @@ def hook_push(logger):
     commit = utils.get(data, 'changes.0.toHash', str)
     secret = request.headers.get('X-Hub-Signature', '').replace('sha256=', '')
     if secret:
-      get_repo_secret = lambda r: utils.get_bitbucket_signature(r.secret, request.data)
+      verify_secret = lambda r: utils.check_signature(
+        r.secret, request.data, secret, hashlib.sha256)
     else:
-      get_repo_secret = lambda r: r.secret
+      verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_BITBUCKET_CLOUD:
     event = request.headers.get('X-Event-Key')
     if event != 'repo:push':
@@ -143,7 +153,7 @@ def hook_push(logger):
 
     commit = utils.get(data, 'push.changes.0.new.target.hash', str)
     secret = None
-    get_repo_secret = lambda r: r.secret
+    verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_GITLAB:
     event = utils.get(data, 'object_kind', str)
     if event != 'push' and event != 'tag_push':
@@ -154,14 +164,14 @@ def hook_push(logger):
     ref = utils.get(data, 'ref', str)
     commit = utils.get(data, 'checkout_sha', str)
     secret = request.headers.get('X-Gitlab-Token')
-    get_repo_secret = lambda r: r.secret
+    verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   elif api == API_BARE:
     owner = utils.get(data, 'owner', str)
     name = utils.get(data, 'name', str)
     ref = utils.get(data, 'ref', str)
     commit = utils.get(data, 'commit', str)
     secret = utils.get(data, 'secret', str)
-    get_repo_secret = lambda r: r.secret
+    verify_secret = lambda r: utils.compare_secret(r.secret, secret)
   else:
     assert False, "unreachable"
 
@@ -189,7 +199,7 @@ def hook_push(logger):
   if not repo:
     logger.error('PUSH event rejected (unknown repository)')
     return 400
-  if get_repo_secret(repo) != secret:
+  if not verify_secret(repo):
     logger.error('PUSH event rejected (invalid secret)')
     return 400
   if not repo.check_accept_ref(ref):
@@ -211,6 +221,33 @@ def hook_push(logger):
   enqueue(build)
   logger.info('Build #{} for repository {} queued'.format(build.num, repo.name))
   logger.info(utils.strip_url_path(config.app_url) + build.url())
+
+  if getattr(config, 'coalesce_builds', False):
+    # Older builds are only superseded once the new build is committed and
+    # queued. Builds started manually have no commit SHA and are kept.
+    no_commit = '0' * 32
+    queued = select(x for x in Build if x.repo == repo and x.ref == ref and
+                    x.status == Build.Status_Queued and x.commit_sha != no_commit
+                    and x.id != build.id)
+    superseded = []
+    for old_build in queued:
+      # A build that a worker already picked up is left alone, the worker
+      # updates its status in its own database session.
+      if dequeue(old_build):
+        old_build.status = Build.Status_Stopped
+        superseded.append(old_build)
+    try:
+      models.commit()
+    except BaseException:
+      # The builds are still queued in the database, put them back.
+      superseded_ids = [x.id for x in superseded]
+      models.rollback()
+      for old_build in select(x for x in Build if x.id in superseded_ids):
+        if old_build.status == Build.Status_Queued:
+          enqueue(old_build)
+      raise
+    for old_build in superseded:
+      logger.info('Build #{} for {!r} superseded'.format(old_build.num, ref))
   return 200
 
 
@@ -259,7 +296,7 @@ def login():
     user_name = request.form['user_name']
     user_password = request.form['user_password']
     if user_name and user_password:
-      user = User.get(name=user_name, passhash=utils.hash_pw(user_password))
+      user = User.get_by_login_details(user_name, user_password)
       if user:
         token = LoginToken.create(request.remote_addr, user)
         session['flux_login_token'] = token.token
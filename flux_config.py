@@ -53,6 +53,11 @@ server_name = os.environ.get('FLUX_SERVER_NAME', app_url.replace('http://', '').
 ## https://api.wordpress.org/secret-key/1.1/salt/
 secret_key = 'ThAHy8oxRiNIQDBnVlNjEVY78fXdWHdi'
 
+## Let the front-end server (eg. Apache with mod_xsendfile) send build
+## artifacts and logs by responding with an X-Sendfile header instead of
+## transferring the file through Flux.
+use_x_sendfile = False
+
 ## The PonyORM database configuration.
 ## https://ponyorm.com/
 database = {
@@ -67,9 +72,15 @@ root_password = 'alpine'
 
 ## The number of builds that may be executed in parallel. One is
 ## usually a good value since today's builds (depending on the used
-## build system) are usually multiprocessed already.
+## build system) are usually multiprocessed already. Set to None to
+## run as many builds in parallel as there are CPUs.
 parallel_builds = 1
 
+## If enabled, a push to a Git ref stops builds of the same repository
+## and ref that are still queued, so that bursts of pushes result in a
+## single build of the most recent commit.
+coalesce_builds = True
+
 ## Filenames of build scripts in a repository. The first matching
 ## filename will be used.
 if os.name == 'nt':
@@ -10,7 +10,7 @@ def package_files(directory):
       paths.append(os.path.join('..', path, filename))
   return paths
 
-if sys.version[:3] < '3.4':
+if sys.version_info < (3, 6):
   raise EnvironmentError('Flux CI is not compatible with Python {}'
                          .format(sys.version[:3]))
 
@@ -0,0 +1,18 @@
+
+import atexit
+import os
+import shutil
+import tempfile
+
+from flux import config
+
+# The database models are bound when flux.models is imported, so the test
+# database must be configured before any test module imports Flux. It is a
+# file rather than ':memory:' so that worker threads see the same tables.
+_tempdir = tempfile.mkdtemp(prefix='flux-test-')
+atexit.register(shutil.rmtree, _tempdir, True)
+config.database = {
+  'provider': 'sqlite',
+  'filename': os.path.join(_tempdir, 'flux.db'),
+  'create_db': True,
+}
@@ -0,0 +1,70 @@
+
+import threading
+
+from flux import build as build_module, models
+from flux.build import BuildConsumer
+from flux.models import Build, Repository
+
+
+def _create_builds(name, count):
+  with models.session():
+    repo = Repository(name=name, clone_url='https://example.com/' + name)
+    models.commit()
+    for i in range(count):
+      Build(repo=repo, commit_sha='a' * 40, num=i, ref='refs/heads/master',
+            status=Build.Status_Queued)
+      models.commit()
+    return [x.id for x in repo.builds.order_by(Build.num)]
+
+
+def test_consumer_put_remove_terminate():
+  ids = _create_builds('test/consumer', 3)
+  consumer = BuildConsumer()
+  with models.session():
+    b1, b2, b3 = (Build[x] for x in ids)
+    consumer.put(b1)
+    consumer.put(b1)
+    consumer.put(b2)
+    consumer.put(b3)
+    assert list(consumer._queue) == ids
+    assert all(consumer.is_running(x) for x in (b1, b2, b3))
+
+    assert consumer.remove(b2)
+    assert not consumer.remove(b2)
+    assert not consumer.is_running(b2)
+    assert b2.status == Build.Status_Queued
+
+    consumer.terminate(b3)
+    assert not consumer.is_running(b3)
+    assert b3.status == Build.Status_Stopped
+
+    # A removed build can be queued again.
+    consumer.put(b2)
+    assert consumer.is_running(b2)
+
+
+def test_consumer_worker_skips_removed_builds(monkeypatch):
+  ids = _create_builds('test/worker', 3)
+  built = []
+  done = threading.Event()
+  def do_build(build_id, terminate_event):
+    built.append(build_id)
+    done.set()
+  monkeypatch.setattr(build_module, 'do_build', do_build)
+
+  consumer = BuildConsumer()
+  with models.session():
+    b1, b2, b3 = (Build[x] for x in ids)
+    consumer.put(b1)
+    consumer.put(b2)
+    consumer.put(b3)
+    consumer.remove(b1)
+    consumer.terminate(b2)
+
+  consumer.start(1)
+  try:
+    assert done.wait(5)
+  finally:
+    consumer.stop()
+  assert built == [b3.id]
+  assert not consumer._queue and not consumer._queued
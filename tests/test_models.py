@@ -0,0 +1,24 @@
+
+from flux import models, utils
+from flux.models import User
+
+
+def test_legacy_password_hash_is_upgraded():
+  with models.session():
+    User(name='legacy', passhash=utils.hash_pw_legacy('secret'),
+         can_manage=False, can_download_artifacts=False,
+         can_view_buildlogs=False)
+
+  with models.session():
+    assert User.get_by_login_details('legacy', 'wrong') is None
+    assert User.get(name='legacy').passhash == utils.hash_pw_legacy('secret')
+
+  with models.session():
+    user = User.get_by_login_details('legacy', 'secret')
+    assert user is not None and user.name == 'legacy'
+
+  with models.session():
+    user = User.get(name='legacy')
+    assert user.passhash == utils.hash_pw('secret')
+    assert User.get_by_login_details('legacy', 'secret') == user
+    assert User.get_by_login_details('legacy', 'wrong') is None
@@ -0,0 +1,126 @@
+
+import hashlib
+import hmac
+import os
+import pytest
+import zipfile
+
+from flux import utils
+
+
+def test_zipdir(tmpdir):
+  root = tmpdir.mkdir('build')
+  root.join('a.txt').write('a')
+  root.mkdir('sub').join('b.txt').write('b')
+  os.symlink(str(root.join('sub')), str(root.join('link')))
+  filename = str(tmpdir.join('build.zip'))
+  utils.zipdir(str(root), filename)
+  with zipfile.ZipFile(filename) as zipf:
+    assert sorted(zipf.namelist()) == ['a.txt', 'sub/b.txt']
+    assert zipf.read('sub/b.txt') == b'b'
+
+
+@pytest.mark.skipif(os.name != 'posix' or os.geteuid() == 0,
+                    reason='requires POSIX permissions and a non-root user')
+def test_zipdir_skips_unreadable_directories(tmpdir):
+  root = tmpdir.mkdir('build')
+  root.join('a.txt').write('a')
+  locked = root.mkdir('locked')
+  locked.join('b.txt').write('b')
+  locked.chmod(0)
+  try:
+    filename = str(tmpdir.join('build.zip'))
+    utils.zipdir(str(root), filename)
+  finally:
+    locked.chmod(0o755)
+  with zipfile.ZipFile(filename) as zipf:
+    assert zipf.namelist() == ['a.txt']
+
+
+def test_get_raise():
+  data = {'a': {'b': [{'c': 1}, {'c': 2}]}}
+  assert utils.get_raise(data, 'a.b.1.c') == 2
+  assert utils.get_raise(data, 'a.b.-1.c', int) == 2
+  assert utils.get_raise(data, 'a.b.+1.c') == 2
+  assert utils.get_raise(data, 'a.b. 0.c') == 1
+  with pytest.raises(KeyError):
+    utils.get_raise(data, 'a.x')
+  with pytest.raises(KeyError):
+    utils.get_raise(data, 'a.b.5')
+  with pytest.raises(TypeError):
+    utils.get_raise(data, 'a.b.c')
+  with pytest.raises(TypeError):
+    utils.get_raise(data, 'a.b.0.c', str)
+
+
+def test_get():
+  data = {'a': {'b': [{'c': 1}, {'c': None}]}}
+  assert utils.get(data, 'a.b.0.c', int) == 1
+  assert utils.get(data, 'a.b.1.c', default='x') is None
+  assert utils.get(data, 'a.x') is None
+  assert utils.get(data, 'a.b.5') is None
+  assert utils.get(data, 'a.b.-3') is None
+  assert utils.get(data, 'a.b.c') is None
+  assert utils.get(data, 'a.0') is None
+  assert utils.get(data, 'a.b.0.c', str) is None
+  assert utils.get(data, 'a.x', default='x') == 'x'
+  assert utils.get(data, 'a.b.5', default='x') == 'x'
+  assert utils.get(data, 'a.b.c', default='x') == 'x'
+  assert utils.get(data, 'a.b.0.c', str, 'x') == 'x'
+
+
+@pytest.mark.parametrize('x_sendfile', [False, True])
+def test_stream_file(tmpdir, x_sendfile):
+  filename = tmpdir.join('artifact.zip')
+  filename.write_binary(b'data')
+  utils.app.config['USE_X_SENDFILE'] = x_sendfile
+  try:
+    with utils.app.test_request_context():
+      response = utils.stream_file(str(filename), mime='application/zip')
+      assert response.status_code == 200
+      assert response.headers['Content-Type'] == 'application/zip'
+      assert response.headers['Content-Length'] == '4'
+      assert response.headers['Content-Disposition'] == 'attachment; filename="artifact.zip"'
+      if x_sendfile:
+        assert response.headers['X-Sendfile'] == str(filename)
+        assert not b''.join(response.response)
+      else:
+        assert 'X-Sendfile' not in response.headers
+        assert b''.join(response.response) == b'data'
+      response.close()
+  finally:
+    utils.app.config['USE_X_SENDFILE'] = False
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='requires POSIX')
+@pytest.mark.parametrize('kwargs,fast_path', [
+  ({}, True),
+  ({'cwd': '/'}, False),
+  ({'env': {}, 'inherit_env': False}, False),
+])
+def test_run_close_fds(monkeypatch, kwargs, fast_path):
+  calls = []
+  popen = utils.subprocess.Popen
+  def spy(*args, **kw):
+    calls.append(kw)
+    return popen(*args, **kw)
+  monkeypatch.setattr(utils.subprocess, 'Popen', spy)
+  assert utils.run(['true'], None, **kwargs) == 0
+  assert calls[0]['close_fds'] == (not fast_path)
+  assert (calls[0]['executable'] is not None) == fast_path
+
+
+@pytest.mark.parametrize('digestmod', [hashlib.sha1, hashlib.sha256])
+def test_check_signature(digestmod):
+  payload = b'{"ref": "refs/heads/master"}'
+  signature = hmac.new(b's3cr\xc3\xa9t', payload, digestmod).hexdigest()
+  assert utils.check_signature('s3cr\xe9t', payload, signature, digestmod)
+  # The second call uses a copy of the cached keyed HMAC object.
+  assert utils.check_signature('s3cr\xe9t', payload, signature, digestmod)
+  assert utils.check_signature('s3cr\xe9t', payload, signature.upper(), digestmod)
+  assert not utils.check_signature('other', payload, signature, digestmod)
+  assert not utils.check_signature('s3cr\xe9t', payload + b' ', signature, digestmod)
+  assert not utils.check_signature('s3cr\xe9t', payload, 'zz' + signature[2:], digestmod)
+  assert not utils.check_signature('s3cr\xe9t', payload, signature[:-2], digestmod)
+  assert not utils.check_signature('s3cr\xe9t', payload, signature + '00', digestmod)
+  assert not utils.check_signature('s3cr\xe9t', payload, '', digestmod)
@@ -0,0 +1,84 @@
+
+import pytest
+
+from flux import app, build, config, models, views
+from flux.models import Build, Repository
+
+NO_COMMIT = '0' * 32
+
+
+@pytest.fixture(autouse=True)
+def _config(monkeypatch):
+  monkeypatch.setattr(config, 'app_url', 'http://localhost:4042', raising=False)
+  monkeypatch.setattr(config, 'coalesce_builds', True, raising=False)
+
+
+def _setup_repo(name):
+  with models.session():
+    repo = Repository(name=name, secret='secret', clone_url='https://example.com/' + name)
+    models.commit()
+    ids = []
+    for commit_sha in ('a' * 40, NO_COMMIT):
+      b = Build(repo=repo, commit_sha=commit_sha, num=repo.build_count,
+                ref='refs/heads/master', status=Build.Status_Queued)
+      repo.build_count += 1
+      models.commit()
+      build.enqueue(b)
+      ids.append(b.id)
+    return ids
+
+
+def _push(name):
+  owner, name = name.split('/')
+  return app.test_client().post('/hook/push?api=bare', json={
+    'owner': owner, 'name': name, 'ref': 'refs/heads/master',
+    'commit': 'b' * 40, 'secret': 'secret'})
+
+
+def _cleanup(name):
+  with models.session():
+    for b in Repository.get(name=name).builds:
+      build.dequeue(b)
+
+
+def test_hook_push_coalesces_builds():
+  old_id, manual_id = _setup_repo('test/coalesce')
+  try:
+    response = _push('test/coalesce')
+    assert response.status_code == 200, response.data
+    with models.session():
+      old_build, manual_build = Build[old_id], Build[manual_id]
+      new_build = Build.get(repo=old_build.repo, commit_sha='b' * 40)
+      assert old_build.status == Build.Status_Stopped
+      assert not build.dequeue(old_build)
+      assert manual_build.status == Build.Status_Queued
+      assert build._consumer.is_running(manual_build)
+      assert new_build.status == Build.Status_Queued
+      assert build._consumer.is_running(new_build)
+  finally:
+    _cleanup('test/coalesce')
+
+
+def test_hook_push_requeues_builds_if_commit_fails(monkeypatch):
+  old_id, manual_id = _setup_repo('test/requeue')
+
+  # Let the commit of the new build pass, fail the one that supersedes.
+  commit, calls = models.commit, []
+  def failing_commit():
+    calls.append(None)
+    if len(calls) > 1:
+      raise RuntimeError('commit failed')
+    commit()
+  monkeypatch.setattr(models, 'commit', failing_commit)
+
+  try:
+    response = _push('test/requeue')
+    assert response.status_code == 500
+    assert b'commit failed' in response.data
+    with models.session():
+      old_build = Build[old_id]
+      assert old_build.status == Build.Status_Queued
+      assert build._consumer.is_running(old_build)
+      assert Build.get(repo=old_build.repo, commit_sha='b' * 40) is not None
+  finally:
+    _cleanup('test/requeue')